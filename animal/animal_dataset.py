@@ -6,36 +6,90 @@ import PIL
 from PIL import Image
 import numpy as np
 
+try:
+    from torchvision.io import read_file, decode_jpeg, ImageReadMode
+except ImportError:
+    decode_jpeg = None
+
 class Animal10(Dataset):
     """ Prepares Animal10 Dataset.
+
+    All images are decoded and normalized once at construction and kept in
+    memory as a single float tensor, so each epoch only pays for indexing
+    and an optional horizontal flip instead of JPEG decode + ToTensor +
+    Normalize per sample.
+
     Args:
         root:           Root directory of dataset.
         split:          Split to be created (train, validation, test).
-        transform:      Optional transforms to apply on data.`
+        mean:           Optional per-channel means for normalization.
+        std:            Optional per-channel stds for normalization.
+        random_flip:    Randomly mirror images on access (train augmentation).
     """
-    def __init__(self, root = None, split = 'train', transform = None):
+    def __init__(self, root = None, split = 'train', mean = None, std = None, random_flip = False):
         self.image_dir = os.path.join(root, split)
         self.image_files = [f for f in listdir(self.image_dir) if os.path.isfile(os.path.join(self.image_dir, f))]
-        self.targets = []
+        targets = []
 
         for path in self.image_files:
             label = path.split('_')[0]
-            self.targets.append(int(label))
+            targets.append(int(label))
+
+        # Keep labels as an int64 tensor in shared memory: DataLoader
+        # workers are persistent, so label corrections written by the main
+        # process must land in storage the forked workers can also see
+        self.targets = torch.from_numpy(np.asarray(targets, dtype = np.int64)).share_memory_()
+
+        self.random_flip = random_flip
+        self.data = self._load_images(mean, std)
+
+    def _load_images(self, mean, std, chunk_size = 512):
+        # Decode with nvJPEG on the GPU when available and normalize there
+        # in chunks; the finished cache still lives on the host. PIL stays
+        # as the fallback for non-JPEG files or CPU-only machines.
+        decode_device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+        mean_t = std_t = None
+        if mean is not None:
+            mean_t = torch.tensor(mean, device = decode_device).view(3, 1, 1)
+            std_t = torch.tensor(std, device = decode_device).view(3, 1, 1)
+
+        chunks = []
+        chunk = []
+        for path in self.image_files:
+            chunk.append(self._decode(os.path.join(self.image_dir, path), decode_device))
+            if len(chunk) == chunk_size:
+                chunks.append(self._normalize(torch.stack(chunk), mean_t, std_t))
+                chunk = []
+        if chunk:
+            chunks.append(self._normalize(torch.stack(chunk), mean_t, std_t))
+        return torch.cat(chunks)
+
+    def _decode(self, path, device):
+        if decode_jpeg is not None:
+            try:
+                return decode_jpeg(read_file(path), mode = ImageReadMode.RGB, device = device)
+            except RuntimeError:
+                pass
+        image = Image.open(path).convert('RGB')
+        return torch.from_numpy(np.asarray(image, dtype = np.uint8)).permute(2, 0, 1).to(device)
 
-        self.transform = transform
+    def _normalize(self, batch, mean_t, std_t):
+        batch = batch.float().div_(255.)
+        if mean_t is not None:
+            batch.sub_(mean_t).div_(std_t)
+        return batch.cpu()
 
     def __getitem__(self, index):
-        image_path = os.path.join(self.image_dir, self.image_files[index])
-        image = Image.open(image_path)
-        if self.transform is not None:
-            image = self.transform(image)
-        label = self.targets[index]
-        label = np.array(label).astype(np.int64)
+        image = self.data[index]
+        if self.random_flip and np.random.rand() < 0.5:
+            image = torch.flip(image, dims = [2])
 
-        return image, torch.from_numpy(label), index
+        return image, self.targets[index], index
 
     def __len__(self):
         return len(self.targets)
 
     def update_corrupted_label(self, noise_label):
-        self.targets[:] = noise_label[:]
+        # In-place write keeps the shared storage, so persistent workers
+        # train on the corrected labels from the next epoch on
+        self.targets[:] = torch.as_tensor(noise_label)
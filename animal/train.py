@@ -3,16 +3,17 @@ sys.path.append('..')
 import os
 import torch
 import torch.nn.parallel
-import torch.nn.functional as F
 from torch.optim.lr_scheduler import MultiStepLR
-import torchvision.transforms as transforms
+from torch.utils.data.distributed import DistributedSampler
+from torch.ao.nn.intrinsic import ConvBnReLU2d, ConvReLU2d
+from torch.nn.utils.fusion import fuse_conv_bn_eval
 import random
 import copy
 import argparse
 from tqdm import tqdm
 import numpy as np
 from termcolor import cprint
-from utils import lrt_correction
+from utils import lrt_correction, DataPrefetcher
 from networks.vgg import vgg19_bn
 from animal_dataset import Animal10
 
@@ -20,6 +21,17 @@ def _init_fn(worker_id):
     np.random.seed(77 + worker_id)
 
 
+def _fold_conv_bn(module):
+    # Replace eval-mode ConvBnReLU2d stages with ConvReLU2d: static
+    # post-training quantization only lowers the BN-folded intrinsic to
+    # fused INT8 kernels, not the QAT-style Conv+BN+ReLU container
+    for name, child in module.named_children():
+        if isinstance(child, ConvBnReLU2d):
+            setattr(module, name, ConvReLU2d(fuse_conv_bn_eval(child[0], child[1]), child[2]))
+        else:
+            _fold_conv_bn(child)
+
+
 def main(args):
     # Initialize random seeds
     random_seed = args.seed
@@ -28,98 +40,180 @@ def main(args):
     torch.manual_seed(random_seed)
     torch.cuda.manual_seed(random_seed)
     torch.cuda.manual_seed_all(random_seed)
-    torch.backends.cudnn.deterministic = True
+    if args.deterministic:
+        torch.backends.cudnn.deterministic = True
+    else:
+        # Let cuDNN autotune its conv algorithms; input shapes are fixed
+        # (drop_last = True), so tuning only happens once per shape
+        torch.backends.cudnn.benchmark = True
 
-    # Select the decive (CPU or CUDA)
-    os.environ["CUDA_VISIBLE_DEVICES"] = str(0)
-    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    # Select the device (CPU or CUDA); multi-GPU runs are launched with
+    # torchrun --nproc_per_node=N train.py
+    local_rank = int(os.environ.get('LOCAL_RANK', 0))
+    distributed = int(os.environ.get('WORLD_SIZE', 1)) > 1
+    if distributed:
+        torch.distributed.init_process_group(backend = 'nccl')
+        torch.cuda.set_device(local_rank)
+    device = torch.device('cuda', local_rank) if torch.cuda.is_available() else torch.device('cpu')
+    rank = torch.distributed.get_rank() if distributed else 0
 
     # Set hyperparameters
     batch_size: int = 128
-    num_workers: int = 2
+    num_workers: int = 8
     lr: float = 0.1
     current_thd: float = 0.3
     thd_increment: float = 0.1
+    accum_steps: int = args.accum_steps
     
-    # Data augmentation
-    transform_train = transforms.Compose([
-        transforms.RandomHorizontalFlip(),
-        transforms.ToTensor(),
-        transforms.Normalize([0.485, 0.456, 0.406], [0.229, 0.224, 0.225]),])
-
-    transform_test = transforms.Compose([
-        transforms.ToTensor(),
-        transforms.Normalize([0.485, 0.456, 0.406], [0.229, 0.224, 0.225]),])
-  
-    trainset = Animal10(root = 'data', split = 'train', transform = transform_train)
-    trainloader = torch.utils.data.DataLoader(trainset, batch_size = batch_size, shuffle = True, num_workers = num_workers, worker_init_fn = _init_fn, drop_last = True)
-
-    valset = Animal10(root = 'data', split = 'val', transform = transform_test)
-    valloader = torch.utils.data.DataLoader(valset, batch_size = batch_size, shuffle = False, num_workers = num_workers)
-    
-    testset = Animal10(root = 'data', split = 'test', transform = transform_test)
-    testloader = torch.utils.data.DataLoader(testset, batch_size = batch_size, shuffle = False, num_workers = num_workers)
+    # Normalization constants, applied once when the datasets cache their
+    # decoded images; random flipping stays per-access in the train set
+    mean = [0.485, 0.456, 0.406]
+    std = [0.229, 0.224, 0.225]
+
+    trainset = Animal10(root = 'data', split = 'train', mean = mean, std = std, random_flip = True)
+    trainsampler = DistributedSampler(trainset) if distributed else None
+    trainloader = torch.utils.data.DataLoader(trainset, batch_size = batch_size, shuffle = (trainsampler is None), sampler = trainsampler, num_workers = num_workers, worker_init_fn = _init_fn, drop_last = True, pin_memory = True, persistent_workers = True, prefetch_factor = 4)
+
+    valset = Animal10(root = 'data', split = 'val', mean = mean, std = std)
+    valsampler = DistributedSampler(valset, shuffle = False) if distributed else None
+    valloader = torch.utils.data.DataLoader(valset, batch_size = batch_size, shuffle = False, sampler = valsampler, num_workers = num_workers, pin_memory = True, persistent_workers = True, prefetch_factor = 4)
+
+    testset = Animal10(root = 'data', split = 'test', mean = mean, std = std)
+    testsampler = DistributedSampler(testset, shuffle = False) if distributed else None
+    testloader = torch.utils.data.DataLoader(testset, batch_size = batch_size, shuffle = False, sampler = testsampler, num_workers = num_workers, pin_memory = True, persistent_workers = True, prefetch_factor = 4)
+
+    # Prefetch train batches to the GPU one step ahead on a side stream
+    if device.type == 'cuda':
+        train_batches = DataPrefetcher(trainloader, device, memory_format = torch.channels_last)
+    else:
+        train_batches = trainloader
 
     num_class = 10
 
-    print('\nTrain set size:', len(trainset))
-    print('\Valid set size:', len(valset))
-    print('Test set size:', len(testset), '\n')
+    if rank == 0:
+        print('\nTrain set size:', len(trainset))
+        print('\Valid set size:', len(valset))
+        print('Test set size:', len(testset), '\n')
 
     # Setup network
     model = vgg19_bn(num_classes = num_class)
-    model = torch.nn.DataParallel(model)
 
-    print("============= Start Training =============")
+    if rank == 0:
+        print("============= Start Training =============")
     loss_func = torch.nn.CrossEntropyLoss()
     optimizer = torch.optim.SGD(model.parameters(), lr = lr, weight_decay = 1e-3)
     scheduler = MultiStepLR(optimizer, milestones = [50, 75], gamma = 0.2)
     model = model.to(device)
+    # NHWC weights let cuDNN pick its Tensor Core conv kernels under AMP
+    model = model.to(memory_format = torch.channels_last)
+    # Keep a handle on the bare module for inference-time optimization;
+    # it shares parameters with the compile/DDP wrappers below
+    base_model = model
+
+    # Compile with Inductor: fuses Conv+BN+ReLU stages and, in
+    # reduce-overhead mode, replays steps through CUDA graphs. Shapes are
+    # static (fixed image size, drop_last = True), so no dynamic tracing.
+    # Compiling happens before the DDP wrap: wrapping the compiled module
+    # leaves DDP's bucketed allreduce hooks at the autograd level, where
+    # they do not fight fullgraph capture the way compiling a DDP-wrapped
+    # model would.
+    model = torch.compile(model, mode = "reduce-overhead", fullgraph = True, dynamic = False)
+
+    if distributed:
+        model = torch.nn.parallel.DistributedDataParallel(model, device_ids = [local_rank])
+
+    # Mixed precision: run conv/linear layers in FP16 and scale the loss
+    use_amp = device.type == 'cuda'
+    scaler = torch.cuda.amp.GradScaler(enabled = use_amp)
     
-    output_record = torch.zeros([30, len(trainset), num_class])
+    # FP16 is plenty for softmax probabilities and halves both the host
+    # footprint of the record and the bytes flushed per epoch
+    output_record = torch.zeros([30, len(trainset), num_class], dtype = torch.float16, pin_memory = (device.type == 'cuda'))
+    # Per-step softmax outputs are staged on the device and flushed to the
+    # pinned host record once per epoch with a single non-blocking copy
+    record_stage = torch.zeros([len(trainset), num_class], dtype = torch.float16, device = device)
     output_selected = torch.zeros([10, len(trainset), num_class])
-    val_record = torch.zeros([30])
+    val_record = np.zeros(30, dtype = np.float32)
+    # Scratch buffer reused by the per-epoch label correction
+    targets_scratch = np.empty(len(trainset), dtype = np.int64)
 
     best_acc = 0
     best_epoch = 0
     best_weights = None
 
     for epoch in range(args.nepoch):
-        # Training
-        train_loss = 0
-        train_correct = 0
+        # Training; loss/correct accumulate as device tensors so the loop
+        # never waits on a GPU-to-CPU sync, and are read out once per epoch
+        train_loss = torch.zeros([], device = device)
+        train_correct = torch.zeros([], device = device, dtype = torch.long)
         train_total = 0
 
+        if distributed:
+            trainsampler.set_epoch(epoch)
+            # Each rank only records its own shard; zero the stage so the
+            # all-reduce below reassembles the full epoch record
+            record_stage.zero_()
+
         model.train()
-        for _, (images, labels, indices) in enumerate(tqdm(trainloader, ascii = True, ncols = 50)):
+        optimizer.zero_grad(set_to_none = True)
+        for step, (images, labels, indices) in enumerate(tqdm(train_batches, ascii = True, ncols = 50, disable = rank != 0)):
             if images.size(0) == 1:
                 continue
 
-            images, labels = images.to(device), labels.to(device)
-            optimizer.zero_grad()
-            outputs = model(images)
-            loss = loss_func(outputs, labels)     
-            loss.backward()
-            optimizer.step()
-            train_loss += loss.item()
+            images = images.to(device, non_blocking = True).contiguous(memory_format = torch.channels_last)
+            labels = labels.to(device, non_blocking = True)
+            with torch.cuda.amp.autocast(enabled = use_amp):
+                outputs = model(images)
+                # Average the loss over the accumulation window so the
+                # effective batch is accum_steps * batch_size
+                loss = loss_func(outputs, labels) / accum_steps
+            scaler.scale(loss).backward()
+            if (step + 1) % accum_steps == 0 or (step + 1) == len(trainloader):
+                scaler.step(optimizer)
+                scaler.update()
+                optimizer.zero_grad(set_to_none = True)
+            train_loss += loss.detach() * accum_steps
             train_total += images.size(0)
             _, predicted = outputs.max(1)
-            train_correct += predicted.eq(labels).sum().item()
-            output_record[epoch % 30, indices] = F.softmax(outputs.detach().cpu(), dim = 1)
+            train_correct += predicted.eq(labels).sum()
+            # Softmax runs in the logits' native (FP16 under AMP) precision;
+            # its internal max-subtraction keeps the 10-way reduction stable
+            probs = outputs.detach().softmax(dim = 1).to(torch.float16)
+            record_stage.index_copy_(0, indices.to(device, non_blocking = True), probs)
+
+        train_loss = train_loss.item()
+        train_correct = train_correct.item()
+
+        if distributed:
+            stats = torch.tensor([train_correct, train_total], dtype = torch.float64, device = device)
+            torch.distributed.all_reduce(stats)
+            train_correct, train_total = stats.tolist()
+            torch.distributed.all_reduce(record_stage)
+
+        output_record[epoch % 30].copy_(record_stage, non_blocking = True)
 
         train_acc = train_correct / train_total * 100.
 
         # Validation
         val_total = 0
-        val_correct = 0
+        val_correct = torch.zeros([], device = device, dtype = torch.long)
         model.eval()
         with torch.no_grad():
             for i, (images, labels, _) in enumerate(valloader):
-                images, labels = images.to(device), labels.to(device)
-                outputs = model(images)
+                images = images.to(device, non_blocking = True).contiguous(memory_format = torch.channels_last)
+                labels = labels.to(device, non_blocking = True)
+                with torch.cuda.amp.autocast(enabled = use_amp):
+                    outputs = model(images)
                 val_total += images.size(0)
                 _, predicted = outputs.max(1)
-                val_correct += predicted.eq(labels).sum().item()
+                val_correct += predicted.eq(labels).sum()
+
+        val_correct = val_correct.item()
+
+        if distributed:
+            stats = torch.tensor([val_correct, val_total], dtype = torch.float64, device = device)
+            torch.distributed.all_reduce(stats)
+            val_correct, val_total = stats.tolist()
 
         val_acc = val_correct / val_total * 100.
         val_record[epoch % 30] = val_acc
@@ -127,37 +221,85 @@ def main(args):
         if val_acc > best_acc:
             best_acc = val_acc
             best_epoch = epoch
-            best_weights = copy.deepcopy(model.state_dict())
+            # Snapshot to host memory instead of deepcopying GPU tensors,
+            # so the best model does not hold a second copy of VRAM
+            best_weights = {k: v.detach().to('cpu', copy = True) for k, v in model.state_dict().items()}
         
         ind = np.argsort(val_record)[-10:]
         
-        cprint("Epoch {}|{}. Train accuracy: {:.2f}%  Val accuracy: {:.2f}".format(epoch + 1, args.nepoch, train_acc, val_acc), "yellow")
-        cprint('>> Top 10 accuracies: {}'.format(np.array(val_record)[ind]), 'green')
+        if rank == 0:
+            cprint("Epoch {}|{}. Train accuracy: {:.2f}%  Val accuracy: {:.2f}".format(epoch + 1, args.nepoch, train_acc, val_acc), "yellow")
+            cprint('>> Top 10 accuracies: {}'.format(val_record[ind]), 'green')
 
         # Correction
         if epoch >= 40:
-            output_selected = output_record[ind].mean(0)
-            y_corrected, current_thd = lrt_correction(np.array(trainset.targets).copy(), output_selected, current_thd = current_thd, thd_increment = thd_increment)
+            # Make sure the non-blocking flush into output_record is done
+            if device.type == 'cuda':
+                torch.cuda.synchronize()
+                # Reduce the [10, N, C] selection on the GPU and ship only
+                # the [N, C] mean back to the host
+                output_selected = output_record[ind].to(device, non_blocking = True).float().mean(0).cpu()
+            else:
+                output_selected = output_record[ind].float().mean(0)
+            np.copyto(targets_scratch, trainset.targets.numpy())
+            y_corrected, current_thd = lrt_correction(targets_scratch, output_selected, current_thd = current_thd, thd_increment = thd_increment)
             trainset.update_corrupted_label(y_corrected)
 
         scheduler.step()
 
     # testing
-    test_total = 0
-    test_correct = 0
-    model.load_state_dict(best_weights)
+    model.load_state_dict({k: v.to(device) for k, v in best_weights.items()})
     model.eval()
 
+    if args.int8_test:
+        # Post-training INT8 quantization: calibrate observers on the
+        # validation set, then convert to fused INT8 conv/linear kernels
+        # (fbgemm) and run the test pass on the CPU
+        from torch.ao.quantization import get_default_qconfig_mapping
+        from torch.ao.quantization.quantize_fx import prepare_fx, convert_fx
+
+        test_device = torch.device('cpu')
+        qmodel = copy.deepcopy(base_model).cpu().eval()
+        _fold_conv_bn(qmodel)
+        example_inputs = (next(iter(valloader))[0],)
+        prepared = prepare_fx(qmodel, get_default_qconfig_mapping('fbgemm'), example_inputs = example_inputs)
+        with torch.no_grad():
+            for i, (images, _, _) in enumerate(valloader):
+                if i >= 100:
+                    break
+                prepared(images)
+        eval_model = convert_fx(prepared)
+    else:
+        test_device = device
+        # Script + optimize_for_inference folds BatchNorm into the conv
+        # weights and fuses Conv+ReLU for the test pass
+        eval_model = torch.jit.optimize_for_inference(torch.jit.script(base_model.eval()))
+
+    test_total = 0
+    test_correct = torch.zeros([], device = test_device, dtype = torch.long)
+
     with torch.no_grad():
         for i, (images, labels, _) in enumerate(testloader):
-            images, labels = images.to(device), labels.to(device)
-            outputs = model(images)
+            images = images.to(test_device, non_blocking = True).contiguous(memory_format = torch.channels_last)
+            labels = labels.to(test_device, non_blocking = True)
+            outputs = eval_model(images)
             test_total += images.size(0)
             _, predicted = outputs.max(1)
-            test_correct += predicted.eq(labels).sum().item()
+            test_correct += predicted.eq(labels).sum()
+
+    test_correct = test_correct.item()
+
+    if distributed:
+        stats = torch.tensor([test_correct, test_total], dtype = torch.float64, device = device)
+        torch.distributed.all_reduce(stats)
+        test_correct, test_total = stats.tolist()
 
     test_acc = test_correct / test_total * 100.
-    cprint('>> Final test accuracy: {:.2f}'.format(test_acc), 'cyan')
+    if rank == 0:
+        cprint('>> Final test accuracy: {:.2f}'.format(test_acc), 'cyan')
+
+    if distributed:
+        torch.distributed.destroy_process_group()
 
     return test_acc
     
@@ -165,5 +307,8 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("--nepoch", default = 100, help = "number of training epochs", type = int)
     parser.add_argument("--seed", default = 77, help = "random seed", type = int)
+    parser.add_argument("--accum_steps", default = 1, help = "micro-batches accumulated per optimizer step", type = int)
+    parser.add_argument("--int8_test", action = 'store_true', help = "quantize the best model to INT8 and run the test pass on CPU")
+    parser.add_argument("--deterministic", action = 'store_true', help = "use deterministic cuDNN kernels (slower, exact reproducibility)")
     args = parser.parse_args()
     main(args)
@@ -1,5 +1,6 @@
 import torch
 import torch.nn as nn
+from torch.ao.nn.intrinsic import ConvBnReLU2d
 from typing import Union, List, Dict, Any, cast
 
 class VGG(nn.Module):
@@ -7,15 +8,23 @@ class VGG(nn.Module):
     def __init__(self, features: nn.Module, num_classes: int = 10) -> None:
         super(VGG, self).__init__()
         self.features = features
-        self.avgpool = nn.AdaptiveAvgPool2d((7, 7))
-        self.classifier = nn.Sequential(
-            nn.Linear(512 * 7 * 7, 4096),
-            nn.ReLU(True),
-            nn.Dropout(),
-            nn.Linear(4096, 4096),
-            nn.ReLU(True),
-            nn.Dropout(),
-            nn.Linear(4096, num_classes),)
+        if num_classes <= 100:
+            # Small label spaces do not need the ImageNet-sized 4096-wide
+            # FC head; global average pooling plus a single linear layer
+            # drops ~120M classifier parameters
+            self.avgpool = nn.AdaptiveAvgPool2d((1, 1))
+            self.classifier = nn.Sequential(
+                nn.Linear(512, num_classes),)
+        else:
+            self.avgpool = nn.AdaptiveAvgPool2d((7, 7))
+            self.classifier = nn.Sequential(
+                nn.Linear(512 * 7 * 7, 4096),
+                nn.ReLU(True),
+                nn.Dropout(),
+                nn.Linear(4096, 4096),
+                nn.ReLU(True),
+                nn.Dropout(),
+                nn.Linear(4096, num_classes),)
         self._initialize_weights()
 
     def forward(self, x: torch.Tensor) -> torch.Tensor:
@@ -46,13 +55,18 @@ def make_layers(layout: List[Union[str, int]]) -> nn.Sequential:
             layers += [nn.MaxPool2d(kernel_size = 2, stride = 2)]
         else:
             v = cast(int, v)
-            conv2d = nn.Conv2d(in_channels, v, kernel_size = 3, padding = 1)
-            layers += [conv2d, nn.BatchNorm2d(v), nn.ReLU(inplace = True)]
+            # The following BatchNorm subtracts the mean, so a conv bias
+            # would be a no-op; drop it and its gradient/optimizer state
+            conv2d = nn.Conv2d(in_channels, v, kernel_size = 3, padding = 1, bias = False)
+            # The intrinsic module marks Conv+BN+ReLU as one fusable unit,
+            # so the compile/quantization flows emit a single kernel for
+            # the triple instead of three with HBM round-trips in between
+            layers += [ConvBnReLU2d(conv2d, nn.BatchNorm2d(v), nn.ReLU(inplace = True))]
             in_channels = v
     return nn.Sequential(*layers)
 
 layout = [64, 64, 'M', 128, 128, 'M', 256, 256, 256, 256, 'M', 512, 512, 512, 512, 'M', 512, 512, 512, 512, 'M']
 
 def vgg19_bn(num_classes: int = 10) -> VGG:
-    model = VGG(make_layers(layout))
+    model = VGG(make_layers(layout), num_classes = num_classes)
     return model
@@ -54,6 +54,56 @@ def check_integrity(fpath, md5 = None):
         return False
     return True
 
+class DataPrefetcher:
+    """ Iterates over a DataLoader and copies the next batch to the GPU on a
+    side CUDA stream, so the host-to-device transfer of batch i+1 overlaps
+    with the compute of batch i.
+    Args:
+        loader:         DataLoader yielding tuples of tensors.
+        device:         CUDA device the batches are copied to.
+        memory_format:  Optional memory format applied to 4D (image) tensors.
+    """
+    def __init__(self, loader, device, memory_format = None):
+        self.loader = loader
+        self.device = device
+        self.memory_format = memory_format
+
+    def __len__(self):
+        return len(self.loader)
+
+    def __iter__(self):
+        self.loader_iter = iter(self.loader)
+        self.stream = torch.cuda.Stream(self.device)
+        self._preload()
+        return self
+
+    def __next__(self):
+        if self.next_batch is None:
+            raise StopIteration
+        torch.cuda.current_stream().wait_stream(self.stream)
+        batch = self.next_batch
+        for t in batch:
+            if isinstance(t, torch.Tensor):
+                t.record_stream(torch.cuda.current_stream())
+        self._preload()
+        return batch
+
+    def _preload(self):
+        try:
+            batch = next(self.loader_iter)
+        except StopIteration:
+            self.next_batch = None
+            return
+        with torch.cuda.stream(self.stream):
+            moved = []
+            for t in batch:
+                if isinstance(t, torch.Tensor):
+                    t = t.to(self.device, non_blocking = True)
+                    if self.memory_format is not None and t.dim() == 4:
+                        t = t.contiguous(memory_format = self.memory_format)
+                moved.append(t)
+        self.next_batch = moved
+
 def lrt_correction(targets, outputs, current_thd = 0.3, thd_increment = 0.1):
 
     corrected_count = 0